@@ -1,13 +1,11 @@
+# -*- coding: utf-8 -*-
 # Generated by the protocol buffer compiler.  DO NOT EDIT!
 # source: appsinstalled.proto
-
-import sys
-_b=sys.version_info[0]<3 and (lambda x:x) or (lambda x:x.encode('latin1'))
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
 from google.protobuf import descriptor as _descriptor
-from google.protobuf import message as _message
-from google.protobuf import reflection as _reflection
+from google.protobuf import descriptor_pool as _descriptor_pool
 from google.protobuf import symbol_database as _symbol_database
-from google.protobuf import descriptor_pb2
 # @@protoc_insertion_point(imports)
 
 _sym_db = _symbol_database.Default()
@@ -15,69 +13,17 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor.FileDescriptor(
-  name='appsinstalled.proto',
-  package='',
-  syntax='proto2',
-  serialized_pb=_b('\n\x13\x61ppsinstalled.proto\"2\n\x08UserApps\x12\x0c\n\x04\x61pps\x18\x01 \x03(\r\x12\x0b\n\x03lat\x18\x02 \x01(\x01\x12\x0b\n\x03lon\x18\x03 \x01(\x01')
-)
-
-
-
-
-_USERAPPS = _descriptor.Descriptor(
-  name='UserApps',
-  full_name='UserApps',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='apps', full_name='UserApps.apps', index=0,
-      number=1, type=13, cpp_type=3, label=3,
-      has_default_value=False, default_value=[],
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='lat', full_name='UserApps.lat', index=1,
-      number=2, type=1, cpp_type=5, label=1,
-      has_default_value=False, default_value=float(0),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-    _descriptor.FieldDescriptor(
-      name='lon', full_name='UserApps.lon', index=2,
-      number=3, type=1, cpp_type=5, label=1,
-      has_default_value=False, default_value=float(0),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      options=None),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  options=None,
-  is_extendable=False,
-  syntax='proto2',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=23,
-  serialized_end=73,
-)
-
-DESCRIPTOR.message_types_by_name['UserApps'] = _USERAPPS
-_sym_db.RegisterFileDescriptor(DESCRIPTOR)
-
-UserApps = _reflection.GeneratedProtocolMessageType('UserApps', (_message.Message,), dict(
-  DESCRIPTOR = _USERAPPS,
-  __module__ = 'appsinstalled_pb2'
-  # @@protoc_insertion_point(class_scope:UserApps)
-  ))
-_sym_db.RegisterMessage(UserApps)
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x13\x61ppsinstalled.proto\"6\n\x08UserApps\x12\x10\n\x04\x61pps\x18\x01 \x03(\rB\x02\x10\x01\x12\x0b\n\x03lat\x18\x02 \x01(\x01\x12\x0b\n\x03lon\x18\x03 \x01(\x01\"8\n\x0cUserAppsList\x12\x0c\n\x04keys\x18\x01 \x03(\t\x12\x1a\n\x07\x65ntries\x18\x02 \x03(\x0b\x32\t.UserApps')
 
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'appsinstalled_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
 
+  DESCRIPTOR._options = None
+  _USERAPPS.fields_by_name['apps']._options = None
+  _USERAPPS.fields_by_name['apps']._serialized_options = b'\020\001'
+  _USERAPPS._serialized_start=23
+  _USERAPPS._serialized_end=77
+  _USERAPPSLIST._serialized_start=79
+  _USERAPPSLIST._serialized_end=135
 # @@protoc_insertion_point(module_scope)
@@ -1,17 +1,37 @@
 import os
 import sys
 import glob
+import gzip
+import mmap
+import asyncio
 import logging
 import collections
-from concurrent.futures import ThreadPoolExecutor
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 from optparse import OptionParser
-import appsinstalled_pb2
+from typing import AsyncIterator, Iterator
+
+import numpy as np
+import zstandard as zstd
 
-from storage_client import StorageManager
+import appsinstalled_pb2
+from storage_client import PIPELINE_DEPTH, AsyncStorageManager
+from tsv_parser import (DEV_TYPES, LINE_BAD_APPS, LINE_BAD_FORMAT, LINE_SLOW_GEO, pack_user_apps,
+                        pack_user_apps_list, parse_chunk, parse_fixed_decimal)
 
 BATCH_SIZE = 100_000
+CHUNK_SIZE = 4 * 1024 * 1024
+GZIP_BLOCK_SIZE = 1024 * 1024
+READ_BUFFER_SIZE = 8 * 1024 * 1024
+PENDING_FILES = 1
 NORMAL_ERR_RATE = 0.01
-AppsInstalled = collections.namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
+# Storage keys are `dev_type:dev_id`, the prefix per device type id is encoded once.
+KEY_PREFIXES = tuple(f"{dev_type}:".encode() for dev_type in DEV_TYPES)
+
+
+def init_logging(log_file: str | None, level: int) -> None:
+    logging.basicConfig(filename=log_file, level=level,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
 
 
 def dot_rename(path) -> None:
@@ -20,106 +40,220 @@ def dot_rename(path) -> None:
     os.rename(path, os.path.join(head, "." + fn))
 
 
-def prepare_data(appsinstalled: AppsInstalled) -> dict[str, str]:
-    ua = appsinstalled_pb2.UserApps()
-    ua.lat = appsinstalled.lat
-    ua.lon = appsinstalled.lon
-    ua.apps.extend(appsinstalled.apps)
-    return {f"{appsinstalled.dev_type}:{appsinstalled.dev_id}": ua.SerializeToString()}
+def compress_batch(keys: list[bytes], values: list[bytes]) -> bytes:
+    """Serialize a batch as `UserAppsList` and compress it with zstd."""
+    return zstd.ZstdCompressor(level=1).compress(pack_user_apps_list(keys, values))
 
 
-def insert_appsinstalled(addr: str, data: dict[str, str], thread_executor: ThreadPoolExecutor, dry_run=False) -> bool:
+async def insert_appsinstalled(dev_type_id: int, keys: list[bytes], values: list[bytes], dry_run=False,
+                               compress=False) -> tuple[bool, int]:
     if dry_run:
-        logging.debug(f"Insert {len(data)} data items.")
-    else:
-        try:
-            future = thread_executor.submit(StorageManager.set_many, addr, data)
-            future.result(timeout=3)
-        except Exception as e:
-            logging.exception(f"Cannot write to storage {addr}: {e}")
-            return False
-        return True
-
-
-def parse_appsinstalled(line) -> AppsInstalled | None:
-
-    line_parts = line.strip().split("\t")
-    if len(line_parts) < 5:
-        return
-
-    dev_type, dev_id, lat, lon, raw_apps = line_parts
-    if not dev_type or not dev_id:
-        return
-
-    try:
-        apps = [int(a.strip()) for a in raw_apps.split(",")]
-    except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isidigit()]
-        logging.info(f"Not all user apps are digits: `{line}`")
-
+        logging.debug(f"Insert {len(keys)} data items.")
+        return True, len(keys)
     try:
-        lat, lon = float(lat), float(lon)
-    except ValueError:
-        logging.info(f"Invalid geo coords: `{line}`")
+        if compress:
+            # One blob per batch, readers have to know the chunk keys and decompress them.
+            blob = await asyncio.to_thread(compress_batch, keys, values)
+            await AsyncStorageManager.set(dev_type_id, f"chunk:{uuid.uuid4().hex}", blob)
+        else:
+            await AsyncStorageManager.set_many_zip(dev_type_id, keys, values)
+    except Exception as e:
+        logging.exception(f"Cannot write to storage {AsyncStorageManager.addrs[dev_type_id]}: {e}")
+        return False, len(keys)
+    return True, len(keys)
+
+
+def fadvise(fd: int, advice: str) -> None:
+    # posix_fadvise is missing on macOS, the hint is just skipped there.
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
+def read_gzip_chunks(fn: str) -> Iterator[bytes]:
+    """Yield the decompressed contents of a gzip file in blocks of whole lines."""
+    with open(fn, "rb", buffering=READ_BUFFER_SIZE) as raw, gzip.GzipFile(fileobj=raw) as fd:
+        fadvise(raw.fileno(), "POSIX_FADV_SEQUENTIAL")
+        buf = bytearray()
+        while block := fd.read(GZIP_BLOCK_SIZE):
+            buf += block
+            if len(buf) < CHUNK_SIZE:
+                continue
+            if cut := buf.rfind(b"\n") + 1:
+                yield buf[:cut]
+                del buf[:cut]
+        if buf:
+            yield buf
+        # The file is read once, don't let it push hotter pages out of the cache.
+        fadvise(raw.fileno(), "POSIX_FADV_DONTNEED")
+
+
+def read_chunks(fn: str) -> Iterator[bytes]:
+    """Yield the file contents in blocks of whole lines."""
+    if fn.endswith(".gz"):
+        yield from read_gzip_chunks(fn)
         return
 
-    return AppsInstalled(dev_type, dev_id, lat, lon, apps)
-
-
-def main(options):
+    with open(fn, "rb") as fd:
+        if not os.fstat(fd.fileno()).st_size:
+            return
+        fadvise(fd.fileno(), "POSIX_FADV_SEQUENTIAL")
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            pos = 0
+            while pos < len(mm):
+                # mmap.find is a plain memchr/memmem over the mapping.
+                nl = mm.find(b"\n", pos + CHUNK_SIZE)
+                end = nl + 1 if nl >= 0 else len(mm)
+                yield mm[pos:end]
+                pos = end
+        fadvise(fd.fileno(), "POSIX_FADV_DONTNEED")
+
+
+def pack_chunk(chunk: bytes) -> tuple[tuple[tuple[list[bytes], list[bytes]], ...], int]:
+    """Parse and serialize a block of lines in a worker process, grouped by device type."""
+    count, lines, dev_types, dev_ids, lats, lons, apps, apps_offsets, flags = parse_chunk(
+        np.frombuffer(chunk, dtype=np.uint8)
+    )
+    packed, packed_offsets = pack_user_apps(count, lats, lons, apps, apps_offsets)
+    packed, packed_offsets = packed.tobytes(), packed_offsets.tolist()
+    # Convert whole columns at once: one C loop per column instead of a numpy scalar per field.
+    columns = zip(
+        dev_types[:count].tolist(), flags[:count].tolist(), dev_ids[:count, 0].tolist(), dev_ids[:count, 1].tolist()
+    )
+
+    data = tuple(([], []) for _ in DEV_TYPES)
+    errors = 0
+    for i, (dev_type_id, line_flags, dev_id_start, dev_id_end) in enumerate(columns):
+        if line_flags or dev_type_id < 0:
+            if line_flags & LINE_BAD_FORMAT:
+                errors += 1
+                continue
+
+            line = str(chunk[lines[i, 0]:lines[i, 1]], "utf-8", errors="replace")
+            if line_flags & LINE_BAD_APPS:
+                logging.info(f"Not all user apps are digits: `{line}`")
+
+            if line_flags & LINE_SLOW_GEO:
+                try:
+                    lat, lon = (float(value) for value in line.split("\t")[2:4])
+                except ValueError:
+                    logging.info(f"Invalid geo coords: `{line}`")
+                    errors += 1
+                    continue
+
+            if dev_type_id < 0:
+                dev_type = line.split("\t", 1)[0]
+                logging.error(f"Unknown device type: {dev_type}")
+                errors += 1
+                continue
+
+        keys, values = data[dev_type_id]
+        keys.append(KEY_PREFIXES[dev_type_id] + chunk[dev_id_start:dev_id_end])
+        if line_flags & LINE_SLOW_GEO:
+            # The parser had no coordinates for this line, so it is serialized the regular way.
+            ua = appsinstalled_pb2.UserApps()
+            ua.lat = lat
+            ua.lon = lon
+            ua.apps.extend(apps[apps_offsets[i]:apps_offsets[i + 1]].tolist())
+            values.append(ua.SerializeToString())
+        else:
+            values.append(packed[packed_offsets[i]:packed_offsets[i + 1]])
+
+    return data, errors
+
+
+async def main_async(options):
     device_storage = {
         "idfa": options.idfa,
         "gaid": options.gaid,
         "adid": options.adid,
         "dvid": options.dvid,
     }
+    # Storages are addressed by device type id, as numbered by the parser.
+    AsyncStorageManager.connect(tuple(device_storage[dev_type] for dev_type in DEV_TYPES))
+    loop = asyncio.get_running_loop()
+    workers = os.cpu_count() or 1
+    pending = asyncio.Semaphore(PIPELINE_DEPTH)
+    process_executor = ProcessPoolExecutor(
+        max_workers=workers, initializer=init_logging, initargs=(options.log, logging.getLogger().level)
+    )
+
+    async def submit(dev_type_id: int, keys: list[bytes], values: list[bytes]) -> asyncio.Task:
+        # Bound the number of batches held in memory while Redis catches up.
+        await pending.acquire()
+        task = asyncio.create_task(insert_appsinstalled(dev_type_id, keys, values, options.dry, options.zstd))
+        task.add_done_callback(lambda _: pending.release())
+        return task
+
+    async def parse_file(fn: str) -> AsyncIterator[tuple[tuple[tuple[list[bytes], list[bytes]], ...], int]]:
+        # Keep every worker busy with a couple of chunks, but yield the results in file order.
+        parsed = collections.deque()
+        chunks = read_chunks(fn)
+        # Reading (and inflating .gz) runs in a thread, zlib releases the GIL and the loop keeps
+        # serving the Redis pipelines meanwhile. The generator is only ever advanced by one call.
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            parsed.append(loop.run_in_executor(process_executor, pack_chunk, chunk))
+            if len(parsed) >= 2 * workers:
+                yield await parsed.popleft()
+        while parsed:
+            yield await parsed.popleft()
+
+    async def finish_file(fn: str, tasks: list[asyncio.Task], errors: int) -> None:
+        processed = 0
+        for ok, count in await asyncio.gather(*tasks):
+            if ok:
+                processed += count
+            else:
+                errors += count
+
+        dot_rename(fn)
 
-    with ThreadPoolExecutor() as thread_executor:
-        for fn in glob.iglob(options.pattern):
+        err_rate = float(errors) / processed if processed else 1
+        if err_rate < NORMAL_ERR_RATE:
+            logging.info(f"Acceptable error rate ({err_rate}) for {fn}. Successfull load")
+        else:
+            logging.error(f"High error rate ({err_rate} > {NORMAL_ERR_RATE}) for {fn}. Failed load")
+
+    loaded = collections.deque()
+    try:
+        # Log names are timestamps, so sorting them gives the chronological order.
+        for fn in sorted(glob.iglob(options.pattern)):
             logging.info(f'Processing {fn}')
-            processed = errors = 0
-            data = {addr: dict() for addr in device_storage.values()}
-
-            with open(fn) as fd:
-                for line in fd:
-
-                    if not (line := line.strip()):
-                        continue
-
-                    if not (appsinstalled := parse_appsinstalled(line)):
-                        errors += 1
-                        continue
-
-                    if not (storage_addr := device_storage.get(appsinstalled.dev_type)):
-                        errors += 1
-                        logging.error(f"Unknown device type: {appsinstalled.dev_type}")
-                        continue
-
-                    data[storage_addr].update(prepare_data(appsinstalled))
-                    if (count := len(data[storage_addr])) >= BATCH_SIZE:
-                        ok = insert_appsinstalled(storage_addr, data[storage_addr], thread_executor, options.dry)
-                        if ok:
-                            processed += count
-                        else:
-                            errors += count
-
-                        data[storage_addr].clear()
-
-            for addr, values_dict in data.items():
-                if values_dict:
-                    ok = insert_appsinstalled(addr, values_dict, thread_executor, options.dry)
-                    if ok:
-                        processed += len(values_dict)
-                    else:
-                        errors += len(values_dict)
-
-            dot_rename(fn)
-
-            err_rate = float(errors) / processed if processed else 1
-            if err_rate < NORMAL_ERR_RATE:
-                logging.info(f"Acceptable error rate ({err_rate}). Successfull load")
-            else:
-                logging.error(f"High error rate ({err_rate} > {NORMAL_ERR_RATE}). Failed load")
+            errors = 0
+            # A batch grows by whole chunk lists; extend() is a pointer copy, so it isn't pre-sized.
+            data = [([], []) for _ in DEV_TYPES]
+            tasks = []
+
+            async for chunk_data, chunk_errors in parse_file(fn):
+                errors += chunk_errors
+                for dev_type_id, (chunk_keys, chunk_values) in enumerate(chunk_data):
+                    keys, values = data[dev_type_id]
+                    keys.extend(chunk_keys)
+                    values.extend(chunk_values)
+                    if len(keys) >= BATCH_SIZE:
+                        tasks.append(await submit(dev_type_id, keys, values))
+                        data[dev_type_id] = ([], [])
+
+            for dev_type_id, (keys, values) in enumerate(data):
+                if keys:
+                    tasks.append(await submit(dev_type_id, keys, values))
+
+            # The tail of this file is written while the next one is parsed. Files are still
+            # finished and renamed in order, and only the oldest one is waited for.
+            loaded.append((fn, tasks, errors))
+            if len(loaded) > PENDING_FILES:
+                await finish_file(*loaded.popleft())
+
+        while loaded:
+            await finish_file(*loaded.popleft())
+    finally:
+        process_executor.shutdown(cancel_futures=True)
+        await AsyncStorageManager.close()
+
+
+def main(options):
+    asyncio.run(main_async(options))
 
 
 def prototest():
@@ -137,20 +271,38 @@ def prototest():
         unpacked.ParseFromString(packed)
         assert ua == unpacked
 
+    count, _, _, _, lats, lons, apps, apps_offsets, _ = parse_chunk(np.frombuffer(sample.encode(), dtype=np.uint8))
+    packed, offsets = pack_user_apps(count, lats, lons, apps, apps_offsets)
+    for i, line in enumerate(sample.splitlines()):
+        _, _, lat, lon, raw_apps = line.split("\t")
+        ua = appsinstalled_pb2.UserApps(lat=float(lat), lon=float(lon), apps=[int(a) for a in raw_apps.split(",")])
+        assert packed[offsets[i]:offsets[i + 1]].tobytes() == ua.SerializeToString()
+
+    geo_cases = (
+        ("55.55", True), ("-104.68583244", True), ("67.7835424444", True), ("+42.", True), (".5", True), ("0", True),
+        ("1e5", False), ("4.2.1", False), ("9007199254740993", False),
+    )
+    for value, expected_ok in geo_cases:
+        buf = np.frombuffer(value.encode(), dtype=np.uint8)
+        parsed, ok = parse_fixed_decimal(buf, 0, len(buf))
+        assert ok == expected_ok, value
+        assert not ok or parsed == float(value), value
+
 
 if __name__ == '__main__':
     op = OptionParser()
     op.add_option("-t", "--test", action="store_true", default=False)
     op.add_option("-l", "--log", action="store", default=None)
     op.add_option("--dry", action="store_true", default=False)
+    op.add_option("--zstd", action="store_true", default=False,
+                  help="store each batch as one zstd-compressed UserAppsList under a chunk:<uuid> key")
     op.add_option("--pattern", action="store", default="*.tsv")
     op.add_option("--idfa", action="store", default="127.0.0.1:6380")
     op.add_option("--gaid", action="store", default="127.0.0.1:6381")
     op.add_option("--adid", action="store", default="127.0.0.1:6382")
     op.add_option("--dvid", action="store", default="127.0.0.1:6383")
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO if not opts.dry else logging.DEBUG,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    init_logging(opts.log, logging.INFO if not opts.dry else logging.DEBUG)
     if opts.test:
         prototest()
         sys.exit(0)
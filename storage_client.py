@@ -1,14 +1,24 @@
+import logging
+
 from pymemcache.client import base
 from redis.client import Redis
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio.retry import Retry as AsyncRetry
 from redis.backoff import ExponentialBackoff
 from redis.retry import Retry
 from redis.exceptions import BusyLoadingError, ConnectionError, TimeoutError
+from redis.utils import HIREDIS_AVAILABLE
+
+# Max number of batches in flight across all storages; also the per-client pool size, so a pool never runs out.
+PIPELINE_DEPTH = 8
+# Keys per MSET command: one huge MSET blocks the Redis event loop for the whole batch.
+MSET_SIZE = 10_000
 
 
 class StorageFabric:
 
     @classmethod
-    def get_client(cls, name: str, addr: str) -> base.Client | Redis:
+    def get_client(cls, name: str, addr: str) -> base.Client | Redis | AsyncRedis:
 
         if name == "memcache":
             return base.Client(addr)
@@ -21,6 +31,15 @@ class StorageFabric:
                 retry_on_error=[BusyLoadingError, ConnectionError, TimeoutError],
                 decode_responses=True,
             )
+        elif name == "async_redis":
+            return AsyncRedis(
+                host=addr.split(":")[0],
+                port=int(addr.split(":")[1]),
+                socket_timeout=3,
+                retry=AsyncRetry(ExponentialBackoff(), 3),
+                retry_on_error=[BusyLoadingError, ConnectionError, TimeoutError],
+                max_connections=PIPELINE_DEPTH,
+            )
         else:
             raise ValueError("Unexpected storage name")
 
@@ -50,3 +69,50 @@ class StorageManager:
     def get(cls, addr: str, key: str) -> str:
         return cls.get_client(addr).get(key)
 
+
+class AsyncStorageManager:
+    # Storage slot i is served by clients[i]; slots sharing an address share the client.
+    addrs: tuple[str, ...] = ()
+    clients: tuple[AsyncRedis, ...] = ()
+
+    @classmethod
+    def connect(cls, addrs: tuple[str, ...]) -> None:
+        # redis-py picks the hiredis reply parser by itself whenever the package is importable.
+        if not HIREDIS_AVAILABLE:
+            logging.warning("hiredis is not installed, Redis replies are parsed in pure Python")
+        by_addr = dict()
+        for addr in addrs:
+            if addr not in by_addr:
+                by_addr[addr] = StorageFabric.get_client("async_redis", addr)
+        cls.addrs = addrs
+        cls.clients = tuple(by_addr[addr] for addr in addrs)
+
+    @classmethod
+    async def set(cls, slot: int, key: str, value: bytes) -> None:
+        await cls.clients[slot].set(key, value)
+
+    @classmethod
+    async def set_many(cls, slot: int, data: dict[bytes, bytes]) -> None:
+        await cls.set_many_zip(slot, list(data.keys()), list(data.values()))
+
+    @classmethod
+    async def set_many_zip(cls, slot: int, keys: list[bytes], values: list[bytes]) -> None:
+        # MSET takes flat key/value arguments, so interleave the lists instead of building a dict.
+        args = [None] * (2 * len(keys))
+        args[::2] = keys
+        args[1::2] = values
+        # All the commands go out in one write and the replies are read back together.
+        async with cls.clients[slot].pipeline(transaction=False) as pipe:
+            for start in range(0, len(args), 2 * MSET_SIZE):
+                pipe.execute_command("MSET", *args[start:start + 2 * MSET_SIZE])
+            await pipe.execute()
+
+    @classmethod
+    async def get(cls, slot: int, key: str) -> bytes | None:
+        return await cls.clients[slot].get(key)
+
+    @classmethod
+    async def close(cls) -> None:
+        for client in set(cls.clients):
+            await client.aclose()
+        cls.addrs = cls.clients = ()
@@ -0,0 +1,287 @@
+import numpy as np
+from numba import njit
+
+DEV_TYPES = ("idfa", "gaid", "adid", "dvid")
+
+# Per-line flags reported by `parse_chunk`.
+LINE_BAD_FORMAT = 1  # wrong number of fields or empty dev_type/dev_id, the line is skipped
+LINE_BAD_APPS = 2  # some app ids are not digits, they are dropped and the rest is kept
+LINE_SLOW_GEO = 4  # lat/lon is not a plain decimal and must be parsed with `float()`
+
+_DEV_TYPE_CODES = np.array([[ord(c) for c in dev_type] for dev_type in DEV_TYPES], dtype=np.uint8)
+# Device types start with distinct letters, so the first byte alone picks the candidate.
+_DEV_TYPE_LUT = np.full(256, -1, dtype=np.int8)
+_DEV_TYPE_LUT[_DEV_TYPE_CODES[:, 0]] = np.arange(len(DEV_TYPES), dtype=np.int8)
+_POW10 = np.array([10.0 ** k for k in range(23)], dtype=np.float64)
+_MAX_EXACT_MANTISSA = 1 << 53
+_MAX_APP_ID = 0xFFFFFFFF
+
+_TAB, _NL, _COMMA, _DOT, _PLUS, _MINUS, _ZERO, _NINE = 9, 10, 44, 46, 43, 45, 48, 57
+
+
+@njit(cache=True)
+def _is_space(c) -> bool:
+    return c == 32 or 9 <= c <= 13
+
+
+@njit(cache=True)
+def _dev_type_id(buf, a, b) -> int:
+    i = _DEV_TYPE_LUT[buf[a]]
+    if i < 0 or b - a != 4:
+        return -1
+    if (buf[a + 1] != _DEV_TYPE_CODES[i, 1] or buf[a + 2] != _DEV_TYPE_CODES[i, 2]
+            or buf[a + 3] != _DEV_TYPE_CODES[i, 3]):
+        return -1
+    return i
+
+
+@njit(cache=True)
+def parse_fixed_decimal(buf, a, b):
+    """Parse `[+-]digits[.digits]` from `buf[a:b]`; return (value, ok).
+
+    The digits are accumulated into an integer mantissa and divided by an exact power of ten,
+    which is correctly rounded while the mantissa fits in 53 bits. Anything else, including
+    exponents, is reported with ok=False and left to `float()`.
+    """
+    neg = False
+    if a < b and (buf[a] == _MINUS or buf[a] == _PLUS):
+        neg = buf[a] == _MINUS
+        a += 1
+
+    mant = 0
+    digits = frac = 0
+    seen_dot = False
+    for i in range(a, b):
+        c = buf[i]
+        if _ZERO <= c <= _NINE:
+            mant = mant * 10 + (c - _ZERO)
+            digits += 1
+            if seen_dot:
+                frac += 1
+            if mant > _MAX_EXACT_MANTISSA:
+                return 0.0, False
+        elif c == _DOT and not seen_dot:
+            seen_dot = True
+        else:
+            return 0.0, False
+
+    if not digits or frac >= _POW10.shape[0]:
+        return 0.0, False
+    # Both operands are exact doubles, so the division is correctly rounded.
+    value = mant / _POW10[frac]
+    return (-value if neg else value), True
+
+
+@njit(cache=True)
+def parse_csv_ints(buf, a, b, out, out_idx):
+    """Append the comma-separated app ids of `buf[a:b]` to `out` starting at `out_idx`.
+
+    Returns `(out, out_idx, ok)`; `out` is reallocated with doubled capacity when it fills up.
+    Tokens that are not plain digits are skipped and reported with ok=False.
+    """
+    ok = True
+    token_start = a
+    for j in range(a, b + 1):
+        if j < b and buf[j] != _COMMA:
+            continue
+        start, end = token_start, j
+        token_start = j + 1
+        while start < end and _is_space(buf[start]):
+            start += 1
+        while end > start and _is_space(buf[end - 1]):
+            end -= 1
+
+        value = 0
+        valid = start < end
+        for k in range(start, end):
+            c = buf[k]
+            if not _ZERO <= c <= _NINE:
+                valid = False
+                break
+            value = value * 10 + (c - _ZERO)
+            if value > _MAX_APP_ID:
+                valid = False
+                break
+        if not valid:
+            ok = False
+            continue
+
+        if out_idx == out.shape[0]:
+            grown = np.empty(2 * out.shape[0], dtype=out.dtype)
+            grown[:out_idx] = out
+            out = grown
+        out[out_idx] = value
+        out_idx += 1
+    return out, out_idx, ok
+
+
+@njit(cache=True)
+def parse_chunk(buf):
+    """Parse a block of whole TSV lines into parallel arrays.
+
+    Returns `(count, lines, dev_types, dev_ids, lats, lons, apps, apps_offsets, flags)`,
+    where `lines` and `dev_ids` hold `[start, end)` byte offsets into `buf` and the apps
+    of the i-th line are `apps[apps_offsets[i]:apps_offsets[i + 1]]`.
+    Empty lines are skipped.
+    """
+    size = buf.shape[0]
+    max_lines = 1
+    for i in range(size):
+        if buf[i] == _NL:
+            max_lines += 1
+
+    lines = np.empty((max_lines, 2), dtype=np.int64)
+    dev_types = np.full(max_lines, -1, dtype=np.int8)
+    dev_ids = np.zeros((max_lines, 2), dtype=np.int64)
+    lats = np.zeros(max_lines, dtype=np.float64)
+    lons = np.zeros(max_lines, dtype=np.float64)
+    apps = np.empty(size // 4 + 16, dtype=np.uint32)
+    apps_offsets = np.zeros(max_lines + 1, dtype=np.int64)
+    flags = np.zeros(max_lines, dtype=np.uint8)
+    fields = np.empty((5, 2), dtype=np.int64)
+
+    count = 0
+    n_apps = 0
+    pos = 0
+    while pos < size:
+        end = pos
+        while end < size and buf[end] != _NL:
+            end += 1
+        next_pos = end + 1
+
+        while pos < end and _is_space(buf[pos]):
+            pos += 1
+        while end > pos and _is_space(buf[end - 1]):
+            end -= 1
+        if pos == end:
+            pos = next_pos
+            continue
+
+        i = count
+        count += 1
+        lines[i, 0] = pos
+        lines[i, 1] = end
+        apps_offsets[i + 1] = n_apps
+
+        n_fields = 0
+        field_start = pos
+        for j in range(pos, end + 1):
+            if j == end or buf[j] == _TAB:
+                if n_fields < 5:
+                    fields[n_fields, 0] = field_start
+                    fields[n_fields, 1] = j
+                n_fields += 1
+                field_start = j + 1
+
+        if n_fields != 5 or fields[0, 0] == fields[0, 1] or fields[1, 0] == fields[1, 1]:
+            flags[i] = LINE_BAD_FORMAT
+            pos = next_pos
+            continue
+
+        dev_types[i] = _dev_type_id(buf, fields[0, 0], fields[0, 1])
+        dev_ids[i, 0] = fields[1, 0]
+        dev_ids[i, 1] = fields[1, 1]
+
+        lat, lat_ok = parse_fixed_decimal(buf, fields[2, 0], fields[2, 1])
+        lon, lon_ok = parse_fixed_decimal(buf, fields[3, 0], fields[3, 1])
+        lats[i] = lat
+        lons[i] = lon
+        if not (lat_ok and lon_ok):
+            flags[i] |= LINE_SLOW_GEO
+
+        apps, n_apps, apps_ok = parse_csv_ints(buf, fields[4, 0], fields[4, 1], apps, n_apps)
+        if not apps_ok:
+            flags[i] |= LINE_BAD_APPS
+        apps_offsets[i + 1] = n_apps
+
+        pos = next_pos
+
+    return count, lines, dev_types, dev_ids, lats, lons, apps, apps_offsets, flags
+
+
+@njit(cache=True)
+def _varint_size(value) -> int:
+    size = 1
+    while value > 0x7F:
+        value >>= 7
+        size += 1
+    return size
+
+
+@njit(cache=True)
+def _put_varint(out, pos, value) -> int:
+    while value > 0x7F:
+        out[pos] = (value & 0x7F) | 0x80
+        value >>= 7
+        pos += 1
+    out[pos] = value
+    return pos + 1
+
+
+@njit(cache=True)
+def _put_double(out, pos, bits) -> int:
+    for k in range(8):
+        out[pos + k] = (bits >> (8 * k)) & 0xFF
+    return pos + 8
+
+
+@njit(cache=True)
+def pack_user_apps(count, lats, lons, apps, apps_offsets):
+    """Serialize the first `count` parsed lines as `UserApps` messages without protobuf.
+
+    The wire format is fixed by appsinstalled.proto: packed `apps` (tag 0x0A, omitted when empty),
+    then `lat` (0x11) and `lon` (0x19) as little-endian doubles. The i-th message is
+    `out[offsets[i]:offsets[i + 1]]`, byte-for-byte what `SerializeToString()` returns.
+    """
+    lat_bits = lats.view(np.uint64)
+    lon_bits = lons.view(np.uint64)
+    n_apps = apps_offsets[count]
+    out = np.empty(count * (1 + 10 + 2 * 9) + n_apps * 5, dtype=np.uint8)
+    offsets = np.empty(count + 1, dtype=np.int64)
+
+    pos = 0
+    for i in range(count):
+        offsets[i] = pos
+        a, b = apps_offsets[i], apps_offsets[i + 1]
+        if a < b:
+            payload = 0
+            for j in range(a, b):
+                payload += _varint_size(apps[j])
+            out[pos] = 0x0A
+            pos = _put_varint(out, pos + 1, payload)
+            for j in range(a, b):
+                pos = _put_varint(out, pos, apps[j])
+        out[pos] = 0x11
+        pos = _put_double(out, pos + 1, lat_bits[i])
+        out[pos] = 0x19
+        pos = _put_double(out, pos + 1, lon_bits[i])
+    offsets[count] = pos
+    return out[:pos], offsets
+
+
+@njit(cache=True)
+def _put_length_delimited(out, pos, tag, blob, sizes) -> int:
+    start = 0
+    for size in sizes:
+        out[pos] = tag
+        pos = _put_varint(out, pos + 1, size)
+        out[pos:pos + size] = blob[start:start + size]
+        pos += size
+        start += size
+    return pos
+
+
+def pack_user_apps_list(keys: list[bytes], values: list[bytes]) -> bytes:
+    """Serialize keys and already serialized `UserApps` values as one `UserAppsList` message.
+
+    The values are embedded as they are (`keys` is tag 0x0A, `entries` is 0x12), instead of
+    parsing them back into messages.
+    """
+    key_sizes = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+    value_sizes = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+    key_blob = np.frombuffer(b"".join(keys), dtype=np.uint8)
+    value_blob = np.frombuffer(b"".join(values), dtype=np.uint8)
+    out = np.empty(key_blob.shape[0] + value_blob.shape[0] + 11 * (len(keys) + len(values)), dtype=np.uint8)
+    pos = _put_length_delimited(out, 0, 0x0A, key_blob, key_sizes)
+    pos = _put_length_delimited(out, pos, 0x12, value_blob, value_sizes)
+    return out[:pos].tobytes()